@@ -11,6 +11,7 @@ import sys
 import numbers
 import itertools
 import os
+import io
 import json
 
 try:
@@ -18,10 +19,26 @@ try:
 except:
     from io import BytesIO as StringIO
 
+try:
+    from functools import lru_cache # Python 3
+except ImportError:
+    # No caching in python 2
+    def lru_cache(maxsize=128):
+        return lambda function: function
+
+# Streams used to communicate with Lisp. In python 3 these are
+# UTF-8 text, without newline translation, so that string lengths
+# are the number of characters sent and received by Lisp
+if sys.version_info[0] >= 3:
+    read_stream = io.TextIOWrapper(sys.stdin.buffer, encoding="utf-8", newline="\n")
+    write_stream = io.TextIOWrapper(sys.stdout.buffer, encoding="utf-8", newline="\n")
+else:
+    read_stream = sys.stdin
+    write_stream = sys.stdout
+
 # Direct stdout to a StringIO buffer,
 # to prevent commands from printing to the output stream
 
-write_stream = sys.stdout
 redirect_stream = StringIO()
 
 sys.stdout = redirect_stream
@@ -42,6 +59,7 @@ class Symbol(object):
     """
     A wrapper around a string, representing a Lisp symbol. 
     """
+    __slots__ = ("_name",)
     def __init__(self, name):
         self._name = name
     def __str__(self):
@@ -66,12 +84,7 @@ class LispCallbackObject (object):
         """
         Delete this object, sending a message to Lisp
         """
-        try:
-            sys.stdout = write_stream
-            write_stream.write("d")
-            send_value(self.handle)
-        finally:
-            sys.stdout = redirect_stream
+        send_value(self.handle, "d")
 
     def __call__(self, *args, **kwargs):
         """
@@ -83,19 +96,18 @@ class LispCallbackObject (object):
         
         # Convert kwargs into a sequence of ":keyword value" pairs
         # appended to the positional arguments
-        allargs = args
+        allargs = list(args)
         for key, value in kwargs.items():
-            allargs += (Symbol(":"+str(key)), value)
+            allargs.append(Symbol(":"+str(key)))
+            allargs.append(value)
+        allargs = tuple(allargs)
 
         old_return_values = return_values # Save to restore after
         try:
             return_values = 0 # Need to send the values
-            sys.stdout = write_stream
-            write_stream.write("c")
-            send_value((self.handle, allargs))
+            send_value((self.handle, allargs), "c")
         finally:
             return_values = old_return_values
-            sys.stdout = redirect_stream
 
         # Wait for a value to be returned.
         # Note that the lisp function may call python before returning
@@ -118,24 +130,14 @@ class UnknownLispObject (object):
         """
         Delete this object, sending a message to Lisp
         """
-        try:
-            sys.stdout = write_stream
-            write_stream.write("d")
-            send_value(self.handle)
-        finally:
-            sys.stdout = redirect_stream
+        send_value(self.handle, "d")
 
     def __str__(self):
         return "UnknownLispObject(\""+self.lisptype+"\", "+str(self.handle)+")"
 
     def __getattr__(self, attr):
         # Check if there is a slot with this name
-        try:
-            sys.stdout = write_stream
-            write_stream.write("s") # Slot access
-            send_value((self.handle, attr))
-        finally:
-            sys.stdout = redirect_stream
+        send_value((self.handle, attr), "s") # Slot access
 
         # Wait for the result
         return message_dispatch_loop()
@@ -157,18 +159,44 @@ return_values = 0 # Try to return values to lisp. If > 0, always return a handle
 # Copyright (c) 2018  Marco Heisig <marco.heisig@fau.de>
 #               2019  Ben Dudson <benjamin.dudson@york.ac.uk>
 
+def lispify_string(x):
+    """
+    Convert a string to a Lisp string, escaping backslashes and double quotes.
+    Most strings contain neither, and are not copied to be escaped
+    """
+    if "\\" in x or '"' in x:
+        x = x.replace("\\", "\\\\").replace('"', '\\"')
+    return "\"" + x + "\""
+
+def lispify_dict(x):
+    """
+    Convert a dict to a Lisp hash table.
+    Note: With dict -> hash table, use :test 'equal so that string keys work as expected
+    """
+    parts = ["#.(let ((table (make-hash-table :test 'equal))) "]
+    append = parts.append
+    for key, value in x.items():
+        append("(setf (gethash ")
+        append(lispify_aux(key))
+        append(" table) ")
+        append(lispify_aux(value))
+        append(") ")
+    append("table)")
+    return "".join(parts)
+
 lispifiers = {
     bool       : lambda x: "T" if x else "NIL",
     type(None) : lambda x: "NIL",
     int        : str,
     float      : str,
-    complex    : lambda x: "#C(" + lispify(x.real) + " " + lispify(x.imag) + ")",
-    list       : lambda x: "#(" + " ".join(lispify(elt) for elt in x) + ")",
-    tuple      : lambda x: "(" + " ".join(lispify(elt) for elt in x) + ")",
-    # Note: With dict -> hash table, use :test 'equal so that string keys work as expected
-    dict       : lambda x: "#.(let ((table (make-hash-table :test 'equal))) " + " ".join("(setf (gethash {} table) {})".format(lispify(key), lispify(value)) for key, value in x.items()) + " table)",
-    str        : lambda x: "\"" + x.replace("\\", "\\\\").replace('"', '\\"')  + "\"",
-    type(u'unicode') : lambda x: "\"" + x.replace("\\", "\\\\").replace('"', '\\"')  + "\"",  # Unicode in python 2
+    complex    : lambda x: "#C(" + lispify_aux(x.real) + " " + lispify_aux(x.imag) + ")",
+    # Note: Lists of numbers are not converted with NumPy. Making an array
+    # and formatting it is slower than lispify_aux on each element
+    list       : lambda x: "#(" + " ".join(map(lispify_aux, x)) + ")",
+    tuple      : lambda x: "(" + " ".join(map(lispify_aux, x)) + ")",
+    dict       : lispify_dict,
+    str        : lispify_string,
+    type(u'unicode') : lispify_string,  # Unicode in python 2
     Symbol     : str,
     UnknownLispObject : lambda x: "#.(py4cl::lisp-object {})".format(x.handle),
 }
@@ -200,15 +228,39 @@ try:
                     + numpy_pickle_location + '")')
         if obj.ndim == 0:
             # Convert to scalar then lispify
-            return lispify(numpy.asscalar(obj))
+            return lispify_aux(numpy.asscalar(obj))
         
-        def nested(obj):
-            """Turns an array into nested ((1 2) (3 4))"""
-            if obj.ndim == 1: 
-                return "("+" ".join([lispify(i) for i in obj])+")" 
-            return "(" + " ".join([nested(obj[i,...]) for i in range(obj.shape[0])]) + ")"
-
-        return "#{:d}A".format(obj.ndim) + nested(obj)
+        flat = obj.ravel(order="C")
+        if obj.dtype.kind in "iu":
+            # Integers convert exactly to python ints,
+            # which are turned into strings faster than by NumPy
+            strings = list(map(str, flat.tolist()))
+        elif obj.dtype.kind == "f" and obj.dtype.itemsize == 8:
+            # Doubles convert exactly to python floats. Use repr,
+            # since in python 2 str rounds to 12 significant digits
+            strings = list(map(repr, flat.tolist()))
+        elif obj.dtype.kind == "f":
+            # Other floats are formatted by NumPy in a single pass,
+            # with the precision of the type.
+            # The strings are the same as str() of each element
+            strings = flat.astype(str).tolist()
+        else:
+            strings = list(map(lispify_aux, flat))
+
+        return "#{:d}A".format(obj.ndim) + nested_strings(strings, obj.shape)
+
+    def nested_strings(strings, shape):
+        """Group a flat list of element strings, in row-major order,
+        into nested lists of the given shape.
+        Example:
+        ['1', '2', '3', '4'], (2, 2)  =>  '((1 2) (3 4))'
+        """
+        for axis in range(len(shape) - 1, -1, -1):
+            length = shape[axis]
+            count = int(numpy.prod(shape[:axis])) # Number of lists on this axis
+            strings = ["(" + " ".join(strings[i * length:(i + 1) * length]) + ")"
+                       for i in range(count)]
+        return strings[0]
 
     # Register the handler to convert Python -> Lisp strings
     lispifiers[numpy.ndarray] = lispify_ndarray
@@ -235,16 +287,32 @@ def lispify(obj):
     if return_values > 0:
         return lispify_handle(obj)
 
-    try:
-        return lispifiers[type(obj)](obj)
-    except KeyError:
-        # Special handling for numbers. This should catch NumPy types
-        # as well as built-in numeric types
-        if isinstance(obj, numeric_base_classes):
-            return str(obj)
-        
-        # Another unknown type. Return a handle to a python object
-        return lispify_handle(obj)
+    return lispify_aux(obj)
+
+def lispify_aux(obj, _type=type, _lispifiers=lispifiers):
+    """
+    Turn a python object into a string which can be parsed by Lisp's reader.
+
+    Used by lispify and the lispifiers to convert values, including the
+    elements of containers, without checking return_values.
+    The default arguments are bound once, so that looking them up
+    is fast when called for every element of a container.
+    """
+    obj_type = _type(obj)
+    if obj_type is int or obj_type is float:
+        return str(obj)
+
+    function = _lispifiers.get(obj_type)
+    if function is not None:
+        return function(obj)
+
+    # Special handling for numbers. This should catch NumPy types
+    # as well as built-in numeric types
+    if isinstance(obj, numeric_base_classes):
+        return str(obj)
+
+    # Another unknown type. Return a handle to a python object
+    return lispify_handle(obj)
 
 def generator(function, stop_value):
     temp = None
@@ -255,14 +323,35 @@ def generator(function, stop_value):
 
 ##################################################################
 
-def recv_string():
+def recv_string(_readline=read_stream.readline, _read=read_stream.read):
     """
     Get a string from the input stream
+
+    The stream methods are bound once, as default arguments
     """
     # First a line containing the length as a string
-    length = int(sys.stdin.readline())
-    # Then the specified number of bytes
-    return sys.stdin.read(length)
+    length = int(_readline())
+    # Then the specified number of characters
+    return _read(length)
+
+# Expressions longer than this are not cached. These usually contain
+# data, such as arrays written out in full, and are rarely repeated
+max_cached_source_length = 1000
+
+def compile_eval(source):
+    """
+    Compile an expression to be evaluated. Code objects for short
+    expressions are cached, so that repeated expressions are only parsed once
+    """
+    # eval strips leading spaces and tabs from strings, but compile does not
+    source = source.lstrip(" \t")
+    if len(source) > max_cached_source_length:
+        return compile(source, "<string>", "eval")
+    return compile_eval_cached(source)
+
+@lru_cache(maxsize=1024)
+def compile_eval_cached(source):
+    return compile(source, "<string>", "eval")
 
 def recv_value():
     """
@@ -271,18 +360,24 @@ def recv_value():
     """
     return eval(recv_string(), eval_globals, eval_locals)
 
-def send_value(value):
+def send_value(value, msg_type=""):
     """
-    Send a value to stdout as a string, with length of string first
+    Send a value to stdout as a string, with length of string first.
+    If given, msg_type is the character marking the type of message,
+    which is sent before the length. The whole message is sent in a
+    single write.
     """
+    # Code run from Lisp may have replaced sys.stdout. Restore it, so that
+    # printed output is not written into the messages to Lisp
+    sys.stdout = redirect_stream
+
     try:
         value_str = lispify(value)
     except Exception as e:
-        # At this point the message type has been sent,
+        # At this point the message type has been chosen,
         # so we can't change to throw an exception/signal condition
         value_str = "Lispify error: " + str(e)
-    print(len(value_str))
-    write_stream.write(value_str)
+    write_stream.write(msg_type + str(len(value_str)) + "\n" + value_str)
     write_stream.flush()
 
 def return_stdout():
@@ -297,16 +392,14 @@ def return_stdout():
         return  # Nothing to send
 
     redirect_stream = StringIO() # New stream, delete old one
+    sys.stdout = redirect_stream
 
     old_return_values = return_values # Save to restore after
     try:
         return_values = 0 # Need to return the string, not a handle
-        sys.stdout = write_stream
-        write_stream.write("p")
-        send_value(contents)
+        send_value(contents, "p")
     finally:
         return_values = old_return_values
-        sys.stdout = redirect_stream
     
 def return_error(err):
     """
@@ -319,30 +412,153 @@ def return_error(err):
     old_return_values = return_values # Save to restore after
     try:
         return_values = 0 # Need to return the error, not a handle
-        sys.stdout = write_stream
-        write_stream.write("e")
-        send_value(str(err))
+        send_value(str(err), "e")
     finally:
         return_values = old_return_values
-        sys.stdout = redirect_stream
 
 def return_value(value):
     """
-    Send a value to stdout
+    Send a value to stdout. Errors are sent with return_error
     """
-    if isinstance(value, Exception):
-        return return_error(value)
-
     return_stdout() # Send stdout if any
     
     # Mark response as a returned value
-    try:
-        sys.stdout = write_stream
-        write_stream.write("r")
-        send_value(value)
-    finally:
-        sys.stdout = redirect_stream
+    send_value(value, "r")
         
+def recv_function_call():
+    """
+    Read a function call from the input stream.
+    Returns the function object, a list of positional arguments
+    and a dict of keyword arguments.
+    """
+    fn_name, allargs = recv_value()
+
+    # Split positional arguments and keywords
+    args = []
+    kwargs = {}
+    if allargs:
+        it = iter(allargs) # Use iterator so we can skip values
+        for arg in it:
+            if isinstance(arg, Symbol):
+                # A keyword. Take the next value
+                kwargs[ str(arg)[1:] ] = next(it)
+                continue
+            args.append(arg)
+
+    # Get the function object. Using eval to handle cases like "math.sqrt" or lambda functions.
+    # The compiled name is cached, but the function is looked up every call,
+    # in case the name has been bound to a different object since
+    if callable(fn_name):
+        function = fn_name # Already callable
+    else:
+        function = eval(compile_eval(fn_name), eval_globals, eval_locals)
+    return function, args, kwargs
+
+def handle_eval():
+    """
+    Evaluate an expression, and return the result
+    """
+    result = eval(compile_eval(recv_string()), eval_globals, eval_locals)
+    return_value(result)
+
+def handle_exec():
+    """
+    Execute a statement
+    """
+    exec(recv_string(), eval_globals, eval_locals)
+    return_value(None)
+
+def handle_function_call():
+    """
+    Run a function, then return the value
+    """
+    function, args, kwargs = recv_function_call()
+    return_value( function(*args, **kwargs) )
+
+def handle_async_call():
+    """
+    Run a function, storing the result to be retrieved later
+    """
+    function, args, kwargs = recv_function_call()
+
+    # Get a handle, and send back to caller.
+    # The handle can be used to fetch
+    # the result using an "R" message.
+
+    handle = next(async_handle)
+    return_value(handle)
+
+    try:
+        # Run function, store result
+        async_results[handle] = (True, function(*args, **kwargs))
+    except Exception as e:
+        # Catching error here so it can
+        # be stored and returned as an error
+        async_results[handle] = (False, e)
+
+def handle_retrieve():
+    """
+    Return the stored result of an asynchronous call
+    """
+    # Request value using handle
+    handle = recv_value()
+    success, value = async_results.pop(handle)
+    if success:
+        return_value(value)
+    else:
+        return_error(value)
+
+def handle_set():
+    """
+    Set variables. Should have the form
+    ( ("var1" value1) ("var2" value2) ...)
+    """
+    setlist = recv_value()
+    eval_locals.update(setlist)
+    # Need to send something back to acknowlege
+    return_value(True)
+
+def handle_return_handles():
+    """
+    Return only handles
+    """
+    global return_values
+    return_values += 1
+
+def handle_return_values():
+    """
+    Return values when possible (default)
+    """
+    global return_values
+    return_values -= 1
+
+def handle_version():
+    """
+    Return version info
+    """
+    return_value(tuple(sys.version_info))
+
+def handle_quit():
+    """
+    Quit
+    """
+    sys.exit(0)
+
+# Functions handling each type of message from Lisp, except
+# "r" which returns from message_dispatch_loop
+message_handlers = {
+    "e" : handle_eval,
+    "x" : handle_exec,
+    "f" : handle_function_call,
+    "a" : handle_async_call,
+    "R" : handle_retrieve,
+    "s" : handle_set,
+    "O" : handle_return_handles,
+    "o" : handle_return_values,
+    "v" : handle_version,
+    "q" : handle_quit,
+}
+
 def message_dispatch_loop():
     """
     Wait for a message, dispatch on the type of message.
@@ -357,95 +573,19 @@ def message_dispatch_loop():
     R  Retrieve value from asynchronous call
     s  Set variable(s) 
     """
-    global return_values  # Controls whether values or handles are returned
-    
     while True:
         try:
             # Read command type
-            cmd_type = sys.stdin.read(1)
-            
-            if cmd_type == "e":  # Evaluate an expression
-                result = eval(recv_string(), eval_globals, eval_locals)
-                return_value(result)
-            
-            elif cmd_type == "f" or cmd_type == "a": # Function call
-                # Get a tuple (function, allargs)
-                fn_name, allargs = recv_value()
-
-                # Split positional arguments and keywords
-                args = []
-                kwargs = {}
-                if allargs:
-                    it = iter(allargs) # Use iterator so we can skip values
-                    for arg in it:
-                        if isinstance(arg, Symbol):
-                            # A keyword. Take the next value
-                            kwargs[ str(arg)[1:] ] = next(it)
-                            continue
-                        args.append(arg)
-                
-                # Get the function object. Using eval to handle cases like "math.sqrt" or lambda functions
-                if callable(fn_name):
-                    function = fn_name # Already callable
-                else:
-                    function = eval(fn_name, eval_globals, eval_locals)
-                if cmd_type == "f":
-                    # Run function then return value
-                    return_value( function(*args, **kwargs) )
-                else:
-                    # Asynchronous
-
-                    # Get a handle, and send back to caller.
-                    # The handle can be used to fetch
-                    # the result using an "R" message.
-                    
-                    handle = next(async_handle)
-                    return_value(handle)
-
-                    try:
-                        # Run function, store result
-                        async_results[handle] = function(*args, **kwargs)
-                    except Exception as e:
-                        # Catching error here so it can
-                        # be stored as the return value
-                        async_results[handle] = e
-    
-            elif cmd_type == "O":  # Return only handles
-                return_values += 1
-
-            elif cmd_type == "o":  # Return values when possible (default)
-                return_values -= 1
-                
-            elif cmd_type == "q": # Quit
-                sys.exit(0)
-                
-            elif cmd_type == "R":
-                # Request value using handle
-                handle = recv_value()
-                return_value( async_results.pop(handle) )
-                
-            elif cmd_type == "r": # Return value from Lisp function
+            cmd_type = read_stream.read(1)
+
+            if cmd_type == "r": # Return value from Lisp function
                 return recv_value()
-            
-            elif cmd_type == "s":
-                # Set variables. Should have the form
-                # ( ("var1" value1) ("var2" value2) ...)
-                setlist = recv_value()
-                for name, value in setlist:
-                    eval_locals[name] = value
-                # Need to send something back to acknowlege
-                return_value(True)
-
-            elif cmd_type == "v":
-                # Version info
-                return_value(tuple(sys.version_info))
-                
-            elif cmd_type == "x": # Execute a statement
-                exec(recv_string(), eval_globals, eval_locals)
-                return_value(None)
-                
-            else:
+
+            handler = message_handlers.get(cmd_type)
+            if handler is None:
                 return_error("Unknown message type '{0}'".format(cmd_type))
+            else:
+                handler()
 
         except KeyboardInterrupt as e:
             return_value(None)
@@ -488,7 +628,7 @@ except:
     # In python2, ensure that fractions are converted to floats
     eval_globals["_py4cl_fraction"] = lambda a,b : float(a)/b
 
-async_results = {}  # Store for function results. Might be Exception
+async_results = {}  # Store for function results, as (success, value or Exception)
 async_handle = itertools.count(0) # Running counter
 
 # Main loop
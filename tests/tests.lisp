@@ -32,6 +32,13 @@
     (assert-true (typep result 'integer))
     (assert-equalp 7 result)))
 
+(deftest eval-leading-whitespace (pytests)
+  ;; Python's eval ignores leading spaces and tabs
+  (assert-equalp 3
+      (py4cl:python-eval " 1+2"))
+  (assert-equalp 3
+      (py4cl:python-eval (format nil "~a1+2" #\Tab))))
+
 (deftest eval-malformed (pytests)
   (assert-condition py4cl:python-error
       (py4cl:python-eval "1 + ")))
@@ -148,6 +155,15 @@
           (py4cl:python-exec "print(\"hello\")")
         "This fails with python 2")))
 
+(deftest exec-print-after-stdout-replaced (pytests)
+  ;; Code which replaces sys.stdout should not print into the messages to Lisp
+  (py4cl:python-exec "import sys; sys.stdout = sys.__stdout__")
+  (assert-equalp "oops
+"
+                 (with-output-to-string (*standard-output*)
+                   (py4cl:python-exec "print('oops')")
+                   (assert-equalp 1 (py4cl:python-eval "1")))))
+
 (deftest call-lambda-no-args (pytests)
   (assert-equalp 3
       (py4cl:python-call "lambda : 3")))
@@ -156,6 +172,11 @@
   (assert-equalp 42
       (py4cl:python-call "abs" -42)))
 
+(deftest call-leading-whitespace (pytests)
+  ;; Function names are evaluated, so leading spaces are ignored
+  (assert-equalp 3
+      (py4cl:python-call " abs" -3)))
+
 (deftest call-one-arg-list (pytests)
   (assert-equalp 9
       (py4cl:python-call "sum" '(3 2 4))))
@@ -200,6 +221,37 @@
   (assert-equalp 42.0
                  (py4cl:python-eval "np.float64(42.0)")))
 
+(deftest eval-numpy-integer-array (pytests)
+  (py4cl:python-exec "import numpy as np")
+  (assert-equalp #2A((1 -2) (3 40000000000))
+                 (py4cl:python-eval "np.array([[1, -2], [3, 40000000000]], dtype=np.int64)"))
+  (assert-equalp #(0 7 255)
+                 (py4cl:python-eval "np.array([0, 7, 255], dtype=np.uint8)"))
+  ;; Lisp arrays of integers are sent to python and back unchanged
+  (assert-equalp #2A((1 2 3) (4 5 6))
+                 (py4cl:python-eval "np.asarray(" #2A((1 2 3) (4 5 6)) ", dtype=np.int32)")))
+
+(deftest eval-numpy-float32-array (pytests)
+  (py4cl:python-exec "import numpy as np")
+  ;; Elements are written with the precision of float32, so 0.1 is not 0.10000000149011612
+  (assert-equalp #(0.5 0.1 1.0)
+                 (py4cl:python-eval "np.array([0.5, 0.1, 1.0], dtype=np.float32)"))
+  (assert-equalp #2A((1.5 -2.25) (0.1 3.0))
+                 (py4cl:python-eval "np.asarray(" #2A((1.5 -2.25) (0.1 3.0)) ", dtype=np.float32)")))
+
+(deftest eval-numpy-empty-axes (pytests)
+  (py4cl:python-exec "import numpy as np")
+  (assert-equalp (make-array '(3 0))
+                 (py4cl:python-eval "np.zeros((3,0))"))
+  ;; Lisp reads #2A() as an array with all dimensions zero
+  (assert-equalp '(0 0)
+                 (array-dimensions (py4cl:python-eval "np.zeros((0,3))"))))
+
+(deftest eval-numpy-object-array (pytests)
+  (py4cl:python-exec "import numpy as np")
+  (assert-equalp #2A((1 "a") (nil 2.5))
+                 (py4cl:python-eval "np.array([[1, 'a'], [None, 2.5]], dtype=object)")))
+
 ;; Simple callback function
 (defun test-func ()
   42)